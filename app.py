@@ -1,25 +1,41 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 import sqlite3
 import os
+import hashlib
+import gzip
+import threading
 from datetime import datetime
 
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(APP_DIR, "pos.db")
 
+_local = threading.local()
+
 def db_conn():
     # SQLite is perfect for MVP. (Render filesystem is ephemeral on free tiers; later we can swap to Postgres.)
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
+    # Each threadpool thread opens its connection once and reuses it for every request it serves,
+    # so requests never share a transaction and don't pay connect/setup cost each time.
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH)
+        conn.row_factory = sqlite3.Row
+        # Safe with WAL: a crash can lose the last commit but never corrupts the DB
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        _local.conn = conn
     return conn
 
 def init_db():
     conn = db_conn()
     cur = conn.cursor()
 
+    # WAL is persistent in the DB file; readers no longer block on a checkout being written
+    cur.execute("PRAGMA journal_mode=WAL;")
+
     cur.execute("""
     CREATE TABLE IF NOT EXISTS products (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -59,16 +75,42 @@ def init_db():
     );
     """)
 
+    # Items are always read per order, in insertion order (the rowid is implicitly the 2nd key)
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_order_items_order_id ON order_items(order_id);")
+
     conn.commit()
-    conn.close()
 
-app = FastAPI(title="BloomNext POS", version="0.1.0")
+# Dev:  uvicorn app:app --reload
+# Prod: uvicorn app:app --host 0.0.0.0 --port $PORT --workers 4 --loop uvloop --http httptools
+# (uvloop and httptools come with uvicorn[standard]; --reload forces a single worker.
+#  Workers each open their own connections and share pos.db through WAL.)
+app = FastAPI(title="BloomNext POS", version="0.1.0", default_response_class=ORJSONResponse)
+
+# Product/order lists repeat the same keys on every row and the UI page is ~14 KB of markup
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 # Serve static assets
 static_dir = os.path.join(APP_DIR, "static")
 os.makedirs(static_dir, exist_ok=True)
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
 
+# The register page is a single static file; read it once instead of on every GET /
+INDEX_HTML: Optional[bytes] = None
+INDEX_HTML_GZ: Optional[bytes] = None
+INDEX_ETAG = INDEX_ETAG_GZ = ""
+try:
+    with open(os.path.join(static_dir, "index.html"), "rb") as f:
+        INDEX_HTML = f.read()
+except FileNotFoundError:
+    # Without the UI file the API still boots; only GET / answers 404
+    pass
+if INDEX_HTML is not None:
+    INDEX_ETAG = '"%s"' % hashlib.md5(INDEX_HTML).hexdigest()
+    # Compressed once here, so GZipMiddleware (which skips encoded responses) never redoes it;
+    # mtime=0 keeps the bytes identical across workers
+    INDEX_HTML_GZ = gzip.compress(INDEX_HTML, compresslevel=9, mtime=0)
+    INDEX_ETAG_GZ = INDEX_ETAG[:-1] + '-gz"'
+
 @app.on_event("startup")
 def startup():
     init_db()
@@ -123,22 +165,93 @@ def dollars_to_cents(x: float) -> int:
     return int(round(x * 100))
 
 def cents_to_dollars(c: int) -> float:
-    return round(c / 100.0, 2)
+    # For integer cents the quotient is already the closest float to the 2-place amount,
+    # so wrapping it in round(..., 2) could never change the result
+    return c / 100
+
+# Output models are filled from our own rows, whose types are already right,
+# so model_construct skips Pydantic's per-field validation.
+def product_to_out(
+    product_id: int, name: str, barcode: Optional[str], price_cents: int, taxable: int, active: int
+) -> ProductOut:
+    return ProductOut.model_construct(
+        id=product_id,
+        name=name,
+        barcode=barcode,
+        price=cents_to_dollars(price_cents),
+        taxable=bool(taxable),
+        active=bool(active)
+    )
 
 def row_product_to_out(r: sqlite3.Row) -> ProductOut:
-    return ProductOut(
-        id=r["id"],
-        name=r["name"],
-        barcode=r["barcode"],
-        price=cents_to_dollars(r["price_cents"]),
-        taxable=bool(r["taxable"]),
-        active=bool(r["active"])
+    return product_to_out(r["id"], r["name"], r["barcode"], r["price_cents"], r["taxable"], r["active"])
+
+def product_columns(p: ProductIn) -> Dict[str, Any]:
+    # Normalized once; the keys are both the SQL named parameters and product_to_out's arguments,
+    # so the same values are written to the DB and echoed back in the response
+    return {
+        "name": p.name.strip(),
+        "barcode": (p.barcode.strip() if p.barcode else None),
+        "price_cents": dollars_to_cents(p.price),
+        "taxable": 1 if p.taxable else 0,
+        "active": 1 if p.active else 0,
+    }
+
+def order_item_to_out(
+    name: str, barcode: Optional[str], unit_price_cents: int, qty: int, taxable: int, line_total_cents: int
+) -> OrderItemOut:
+    return OrderItemOut.model_construct(
+        name=name,
+        barcode=barcode,
+        unit_price=cents_to_dollars(unit_price_cents),
+        qty=qty,
+        taxable=bool(taxable),
+        line_total=cents_to_dollars(line_total_cents)
+    )
+
+def order_to_out(
+    order_id: int, created_at: str, subtotal_cents: int, tax_cents: int, total_cents: int,
+    payment_method: str, notes: Optional[str], items: List[OrderItemOut]
+) -> OrderOut:
+    return OrderOut.model_construct(
+        id=order_id,
+        created_at=created_at,
+        subtotal=cents_to_dollars(subtotal_cents),
+        tax=cents_to_dollars(tax_cents),
+        total=cents_to_dollars(total_cents),
+        payment_method=payment_method,
+        notes=notes,
+        items=items
+    )
+
+def row_order_to_out(o: sqlite3.Row, items: List[sqlite3.Row]) -> OrderOut:
+    return order_to_out(
+        o["id"], o["created_at"], o["subtotal_cents"], o["tax_cents"], o["total_cents"],
+        o["payment_method"], o["notes"],
+        [
+            order_item_to_out(
+                r["name_snapshot"], r["barcode_snapshot"], r["unit_price_cents"],
+                r["qty"], r["taxable_snapshot"], r["line_total_cents"]
+            ) for r in items
+        ]
     )
 
 # ---------- Pages ----------
 @app.get("/", response_class=HTMLResponse)
-def home():
-    return FileResponse(os.path.join(APP_DIR, "index.html"))
+def home(request: Request):
+    if INDEX_HTML is None:
+        raise HTTPException(status_code=404, detail="index.html not found")
+    gzip_ok = "gzip" in request.headers.get("accept-encoding", "")
+    body, etag = (INDEX_HTML_GZ, INDEX_ETAG_GZ) if gzip_ok else (INDEX_HTML, INDEX_ETAG)
+    # Browsers revalidate on every load; an unchanged page costs a 304 with no body
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    # If-None-Match uses weak comparison (RFC 9110 13.1.2): W/ prefixes are ignored and * matches any
+    if_none_match = [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]
+    if "*" in if_none_match or etag in [tag[2:] if tag.startswith("W/") else tag for tag in if_none_match]:
+        return Response(status_code=304, headers=headers)
+    if gzip_ok:
+        headers["Content-Encoding"] = "gzip"
+    return HTMLResponse(body, headers=headers)
 
 @app.get("/health")
 def health():
@@ -154,7 +267,6 @@ def list_products(active_only: bool = False):
     else:
         cur.execute("SELECT * FROM products ORDER BY id DESC;")
     rows = cur.fetchall()
-    conn.close()
     return [row_product_to_out(r) for r in rows]
 
 @app.get("/api/products/lookup", response_model=Optional[ProductOut])
@@ -163,7 +275,6 @@ def lookup_product(barcode: str):
     cur = conn.cursor()
     cur.execute("SELECT * FROM products WHERE barcode=? AND active=1 LIMIT 1;", (barcode,))
     r = cur.fetchone()
-    conn.close()
     if not r:
         return None
     return row_product_to_out(r)
@@ -172,57 +283,34 @@ def lookup_product(barcode: str):
 def create_product(p: ProductIn):
     conn = db_conn()
     cur = conn.cursor()
+    cols = product_columns(p)
     try:
-        cur.execute(
-            "INSERT INTO products (name, barcode, price_cents, taxable, active, created_at) VALUES (?, ?, ?, ?, ?, ?);",
-            (
-                p.name.strip(),
-                (p.barcode.strip() if p.barcode else None),
-                dollars_to_cents(p.price),
-                1 if p.taxable else 0,
-                1 if p.active else 0,
-                datetime.utcnow().isoformat()
+        # The connection outlives the request, so let `with conn` roll back a failed insert
+        with conn:
+            cur.execute(
+                "INSERT INTO products (name, barcode, price_cents, taxable, active, created_at) VALUES (:name, :barcode, :price_cents, :taxable, :active, :created_at);",
+                {**cols, "created_at": datetime.utcnow().isoformat()}
             )
-        )
-        conn.commit()
-        new_id = cur.lastrowid
-        cur.execute("SELECT * FROM products WHERE id=?;", (new_id,))
-        r = cur.fetchone()
-        return row_product_to_out(r)
+        return product_to_out(cur.lastrowid, **cols)
     except sqlite3.IntegrityError:
         raise HTTPException(status_code=409, detail="Barcode already exists. Use a different barcode.")
-    finally:
-        conn.close()
 
 @app.put("/api/products/{product_id}", response_model=ProductOut)
 def update_product(product_id: int, p: ProductIn):
     conn = db_conn()
     cur = conn.cursor()
+    cols = product_columns(p)
     try:
-        cur.execute("SELECT * FROM products WHERE id=?;", (product_id,))
-        existing = cur.fetchone()
-        if not existing:
-            raise HTTPException(status_code=404, detail="Product not found")
-
-        cur.execute(
-            "UPDATE products SET name=?, barcode=?, price_cents=?, taxable=?, active=? WHERE id=?;",
-            (
-                p.name.strip(),
-                (p.barcode.strip() if p.barcode else None),
-                dollars_to_cents(p.price),
-                1 if p.taxable else 0,
-                1 if p.active else 0,
-                product_id
+        with conn:
+            cur.execute(
+                "UPDATE products SET name=:name, barcode=:barcode, price_cents=:price_cents, taxable=:taxable, active=:active WHERE id=:id;",
+                {**cols, "id": product_id}
             )
-        )
-        conn.commit()
-        cur.execute("SELECT * FROM products WHERE id=?;", (product_id,))
-        r = cur.fetchone()
-        return row_product_to_out(r)
+        if cur.rowcount == 0:
+            raise HTTPException(status_code=404, detail="Product not found")
+        return product_to_out(product_id, **cols)
     except sqlite3.IntegrityError:
         raise HTTPException(status_code=409, detail="Barcode already exists. Use a different barcode.")
-    finally:
-        conn.close()
 
 @app.delete("/api/products/{product_id}")
 def delete_product(product_id: int):
@@ -231,13 +319,11 @@ def delete_product(product_id: int):
     cur.execute("SELECT * FROM products WHERE id=?;", (product_id,))
     existing = cur.fetchone()
     if not existing:
-        conn.close()
         raise HTTPException(status_code=404, detail="Product not found")
 
     # Soft delete (active=0)
-    cur.execute("UPDATE products SET active=0 WHERE id=?;", (product_id,))
-    conn.commit()
-    conn.close()
+    with conn:
+        cur.execute("UPDATE products SET active=0 WHERE id=?;", (product_id,))
     return {"ok": True}
 
 # ---------- Orders API ----------
@@ -249,105 +335,68 @@ def checkout(payload: CheckoutIn):
     conn = db_conn()
     cur = conn.cursor()
 
-    # Load products for cart
-    product_map = {}
+    # Load products for cart in one query (repeated scans of the same item share a row)
+    product_ids = list({it.product_id for it in payload.items})
+    placeholders = ",".join("?" * len(product_ids))
+    cur.execute(f"SELECT * FROM products WHERE id IN ({placeholders}) AND active=1;", product_ids)
+    product_map = {r["id"]: r for r in cur.fetchall()}
     for it in payload.items:
-        cur.execute("SELECT * FROM products WHERE id=? AND active=1;", (it.product_id,))
-        r = cur.fetchone()
-        if not r:
-            conn.close()
+        if it.product_id not in product_map:
             raise HTTPException(status_code=404, detail=f"Product not found or inactive: {it.product_id}")
-        product_map[it.product_id] = r
 
+    # Decide once whether tax applies; with it off (the default) the taxable base is never needed
+    apply_tax = payload.tax_enabled and payload.tax_rate > 0
     subtotal_cents = 0
     taxable_base_cents = 0
-    items_out: List[OrderItemOut] = []
+    lines = []
 
+    # Price each line once; the same figures feed the totals and the snapshots below
     for it in payload.items:
         pr = product_map[it.product_id]
-        unit = int(pr["price_cents"])
-        qty = int(it.qty)
+        # INTEGER columns come back as int and qty is validated, so no re-coercion here
+        unit = pr["price_cents"]
+        qty = it.qty
         line = unit * qty
         subtotal_cents += line
 
-        is_taxable = bool(pr["taxable"])
-        if payload.tax_enabled and is_taxable:
+        taxable = pr["taxable"]  # stored as 0/1
+        if apply_tax and taxable:
             taxable_base_cents += line
 
-        items_out.append(
-            OrderItemOut(
-                name=pr["name"],
-                barcode=pr["barcode"],
-                unit_price=cents_to_dollars(unit),
-                qty=qty,
-                taxable=is_taxable,
-                line_total=cents_to_dollars(line)
-            )
-        )
+        lines.append((it.product_id, pr["name"], pr["barcode"], unit, qty, taxable, line))
 
     tax_cents = 0
-    if payload.tax_enabled and payload.tax_rate > 0:
+    if apply_tax:
         tax_cents = int(round(taxable_base_cents * payload.tax_rate))
 
     total_cents = subtotal_cents + tax_cents
 
     created_at = datetime.utcnow().isoformat()
 
-    # Create order
-    cur.execute(
-        "INSERT INTO orders (created_at, subtotal_cents, tax_cents, total_cents, payment_method, notes) VALUES (?, ?, ?, ?, ?, ?);",
-        (created_at, subtotal_cents, tax_cents, total_cents, payload.payment_method, payload.notes)
-    )
-    order_id = cur.lastrowid
-
-    # Create order items snapshots
-    for it in payload.items:
-        pr = product_map[it.product_id]
-        unit = int(pr["price_cents"])
-        qty = int(it.qty)
-        line = unit * qty
+    # Order and its item snapshots commit together, or not at all
+    with conn:
+        # Create order
         cur.execute(
+            "INSERT INTO orders (created_at, subtotal_cents, tax_cents, total_cents, payment_method, notes) VALUES (?, ?, ?, ?, ?, ?);",
+            (created_at, subtotal_cents, tax_cents, total_cents, payload.payment_method, payload.notes)
+        )
+        order_id = cur.lastrowid
+
+        # Create order items snapshots
+        cur.executemany(
             """INSERT INTO order_items
                (order_id, product_id, name_snapshot, barcode_snapshot, unit_price_cents, qty, taxable_snapshot, line_total_cents)
                VALUES (?, ?, ?, ?, ?, ?, ?, ?);""",
-            (
-                order_id,
-                it.product_id,
-                pr["name"],
-                pr["barcode"],
-                unit,
-                qty,
-                1 if bool(pr["taxable"]) else 0,
-                line
-            )
+            [(order_id, *ln) for ln in lines]
         )
 
-    conn.commit()
-
-    # Read back
-    cur.execute("SELECT * FROM orders WHERE id=?;", (order_id,))
-    o = cur.fetchone()
-    cur.execute("SELECT * FROM order_items WHERE order_id=? ORDER BY id ASC;", (order_id,))
-    oi = cur.fetchall()
-    conn.close()
-
-    return OrderOut(
-        id=o["id"],
-        created_at=o["created_at"],
-        subtotal=cents_to_dollars(o["subtotal_cents"]),
-        tax=cents_to_dollars(o["tax_cents"]),
-        total=cents_to_dollars(o["total_cents"]),
-        payment_method=o["payment_method"],
-        notes=o["notes"],
-        items=[
-            OrderItemOut(
-                name=r["name_snapshot"],
-                barcode=r["barcode_snapshot"],
-                unit_price=cents_to_dollars(r["unit_price_cents"]),
-                qty=r["qty"],
-                taxable=bool(r["taxable_snapshot"]),
-                line_total=cents_to_dollars(r["line_total_cents"])
-            ) for r in oi
+    # Answer from the values just committed rather than reading the order back
+    return order_to_out(
+        order_id, created_at, subtotal_cents, tax_cents, total_cents,
+        payload.payment_method, payload.notes,
+        [
+            order_item_to_out(name, barcode, unit, qty, taxable, line)
+            for _, name, barcode, unit, qty, taxable, line in lines
         ]
     )
 
@@ -358,32 +407,15 @@ def recent_orders(limit: int = 20):
     cur = conn.cursor()
     cur.execute("SELECT * FROM orders ORDER BY id DESC LIMIT ?;", (limit,))
     orders = cur.fetchall()
-
-    out: List[OrderOut] = []
-    for o in orders:
-        cur.execute("SELECT * FROM order_items WHERE order_id=? ORDER BY id ASC;", (o["id"],))
-        oi = cur.fetchall()
-        out.append(
-            OrderOut(
-                id=o["id"],
-                created_at=o["created_at"],
-                subtotal=cents_to_dollars(o["subtotal_cents"]),
-                tax=cents_to_dollars(o["tax_cents"]),
-                total=cents_to_dollars(o["total_cents"]),
-                payment_method=o["payment_method"],
-                notes=o["notes"],
-                items=[
-                    OrderItemOut(
-                        name=r["name_snapshot"],
-                        barcode=r["barcode_snapshot"],
-                        unit_price=cents_to_dollars(r["unit_price_cents"]),
-                        qty=r["qty"],
-                        taxable=bool(r["taxable_snapshot"]),
-                        line_total=cents_to_dollars(r["line_total_cents"])
-                    ) for r in oi
-                ]
-            )
-        )
-
-    conn.close()
-    return out
+    if not orders:
+        return []
+
+    # One query for the items of every listed order, instead of one query per order
+    order_ids = [o["id"] for o in orders]
+    placeholders = ",".join("?" * len(order_ids))
+    cur.execute(f"SELECT * FROM order_items WHERE order_id IN ({placeholders}) ORDER BY id ASC;", order_ids)
+    items_by_order = {order_id: [] for order_id in order_ids}
+    for r in cur.fetchall():
+        items_by_order[r["order_id"]].append(r)
+
+    return [row_order_to_out(o, items_by_order[o["id"]]) for o in orders]